@@ -2,12 +2,33 @@
 from airflow import DAG
 from airflow.operators.python_operator import PythonOperator
 from datetime import datetime, timedelta, date
+import csv
+import hashlib
+import heapq
+import io
+import json
+import os
+import re
+import time
 import requests
-import psycopg2
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-import random
+import numpy as np
+from collections import namedtuple
+from contextlib import contextmanager
 from typing import List, Dict, Any, Optional
-from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+try:
+    import orjson
+except ImportError:  # immagine Airflow senza orjson: si usa il parser json standard
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # senza ijson il file Overpass viene caricato per intero
+    ijson = None
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +49,67 @@ POSTGRES_CONFIG = {
     'database': 'near_you_shops'
 }
 
+# Pool di connessioni del processo: ogni task Airflow gira in un processo a sé,
+# quindi il pool evita solo le riconnessioni tra gli accessi di uno stesso task
+POOL_MIN_CONN = 1
+POOL_MAX_CONN = 8
+_POOL: Optional[ThreadedConnectionPool] = None
+
+def _get_pool() -> ThreadedConnectionPool:
+    """Restituisce il pool verso POSTGRES_CONFIG, creandolo al primo utilizzo."""
+    global _POOL
+    if _POOL is None or _POOL.closed:
+        _POOL = ThreadedConnectionPool(POOL_MIN_CONN, POOL_MAX_CONN, **POSTGRES_CONFIG)
+    return _POOL
+
+@contextmanager
+def pg_connection():
+    """Presta una connessione dal pool e la restituisce a fine blocco."""
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+# Overpass API: sessione HTTP riutilizzata (keep-alive) con retry e backoff
+# sugli errori transitori; la query è in sola lettura, quindi il POST è ripetibile
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+# Secondi di attesa: Overpass sotto carico può impiegare minuti a rispondere
+OVERPASS_TIMEOUT = 180
+# Limite lato server nella query, sotto il timeout client per lasciare margine
+# al trasferimento: oltre questo Overpass risponde con un 'remark' di errore
+OVERPASS_QUERY_TIMEOUT = OVERPASS_TIMEOUT - 30
+OVERPASS_QUERY = f"""
+[out:json][timeout:{OVERPASS_QUERY_TIMEOUT}];
+area["name"="Milano"]->.searchArea;
+(
+  node["shop"](area.searchArea);
+  way["shop"](area.searchArea);
+  relation["shop"](area.searchArea);
+);
+out center;
+"""
+# Stessa selezione, ma Overpass restituisce solo il numero di elementi
+OVERPASS_COUNT_QUERY = OVERPASS_QUERY.replace("out center;", "out count;")
+# Il payload grezzo passa su file (con cache) nel volume condiviso airflow_data
+OVERPASS_DATA_DIR = os.path.join(os.environ.get('AIRFLOW_HOME', '/opt/airflow_home'), 'tmp')
+OVERPASS_CHUNK_SIZE = 64 * 1024
+# Risposta riusata per 6 ore: retry e riesecuzioni non riscaricano il payload
+OVERPASS_CACHE_TTL = 6 * 3600
+# Se il numero di negozi non cambia si salta l'ETL, ma al massimo per 72 ore
+OVERPASS_STATE_PATH = os.path.join(OVERPASS_DATA_DIR, 'overpass_state.json')
+OVERPASS_REFRESH_MAX_AGE = 72 * 3600
+_SESSION = requests.Session()
+_SESSION.headers.update({'Accept-Encoding': 'gzip, deflate', 'User-Agent': 'nearyou-etl/1.0'})
+_SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(
+    total=5,
+    backoff_factor=2,
+    status_forcelist=(429, 502, 503, 504),
+    allowed_methods=frozenset({'POST'}),
+    raise_on_status=False
+)))
+
 # ===== CONFIGURAZIONE OFFERTE COMPLETA (ITALIANO + INGLESE) =====
 CATEGORY_DISCOUNT_RANGES = {
     # Categorie originali italiane (mantieni per compatibilità)
@@ -284,193 +366,316 @@ DEFAULT_DURATION_RANGE = (7, 30)
 DEFAULT_MAX_USES_RANGE = (50, 200)
 MIN_OFFERS_PER_SHOP = 1
 MAX_OFFERS_PER_SHOP = 3
+GENERIC_DESCRIPTIONS = [
+    "Offerta speciale da {shop_name}!",
+    "Sconto del {discount}% per te!",
+    "Promozione esclusiva: approfitta ora!"
+]
+AGE_RANGES = [(18, 30), (25, 45), (35, 65), (50, 75)]
+AGE_TARGETING_PROBABILITY = 0.3
+
+# Generazione offerte parallela: numero di shard (shop_id % OFFERS_CHUNKS) e pool Airflow
+# che limita le connessioni concorrenti verso postgres-postgis
+OFFERS_CHUNKS = 8
+OFFERS_POOL = 'postgres_writers'
+# Righe per fetch del cursore server-side sui negozi: ogni blocco estratto
+# (fino a SHOPS_FETCH_SIZE * MAX_OFFERS_PER_SHOP offerte) è scritto con un solo INSERT
+SHOPS_FETCH_SIZE = 5000
+
+# Colonne scritte da _insert_offers, nell'ordine degli array passati a unnest()
+OFFER_INSERT_COLUMNS = (
+    'shop_id', 'discount_percent', 'description', 'offer_type',
+    'valid_from', 'valid_until', 'is_active', 'max_uses', 'current_uses',
+    'min_age', 'max_age'
+)
+
+# Negozi idonei: categoria valida e nessuna offerta attiva ancora in corso
+ELIGIBLE_SHOPS_FILTER = """
+    s.category IS NOT NULL 
+    AND s.category != '' 
+    AND s.category != 'Non specificato'
+    AND NOT EXISTS (
+        SELECT 1 FROM offers o
+        WHERE o.shop_id = s.shop_id
+          AND o.is_active = true
+          AND o.valid_until >= CURRENT_DATE
+    )
+"""
+
+# ===== PROFILI PER CATEGORIA =====
+# Tutta la configurazione di una categoria in un'unica struttura: una sola
+# lookup per negozio invece di una per ciascun dizionario CATEGORY_*.
+CategoryProfile = namedtuple('CategoryProfile', [
+    'disc_lo', 'disc_hi', 'dur_lo', 'dur_hi', 'prob', 'uses_lo', 'uses_hi', 'descriptions'
+])
+
+def _build_profile(category: Optional[str]) -> CategoryProfile:
+    """Costruisce il profilo di una categoria applicando i default mancanti."""
+    return CategoryProfile(
+        *CATEGORY_DISCOUNT_RANGES.get(category, DEFAULT_DISCOUNT_RANGE),
+        *CATEGORY_OFFER_DURATION.get(category, DEFAULT_DURATION_RANGE),
+        CATEGORY_OFFER_PROBABILITY.get(category, 0.5),
+        *CATEGORY_MAX_USES.get(category, DEFAULT_MAX_USES_RANGE),
+        tuple(CATEGORY_DESCRIPTIONS.get(category, GENERIC_DESCRIPTIONS))
+    )
+
+_CATEGORY_NAMES = sorted(
+    set(CATEGORY_DISCOUNT_RANGES) | set(CATEGORY_OFFER_DURATION)
+    | set(CATEGORY_OFFER_PROBABILITY) | set(CATEGORY_MAX_USES)
+    | set(CATEGORY_DESCRIPTIONS)
+)
+DEFAULT_PROFILE = _build_profile(None)
+CATEGORY_TABLE = {name: _build_profile(name) for name in _CATEGORY_NAMES}
+
+# ===== TABELLE VETTORIALI PER CATEGORIA =====
+# Ogni categoria ha un indice intero; DEFAULT_CATEGORY_IDX (0) è il profilo di default.
+# Le tabelle permettono di estrarre i campi di tutte le offerte con una sola
+# chiamata numpy per colonna invece di un random.* per offerta.
+DEFAULT_CATEGORY_IDX = 0
+CAT_TO_IDX = {name: i for i, name in enumerate(_CATEGORY_NAMES, start=DEFAULT_CATEGORY_IDX + 1)}
+_PROFILES = [DEFAULT_PROFILE] + [CATEGORY_TABLE[name] for name in _CATEGORY_NAMES]
+
+# Parametri numerici di ogni categoria in un unico array strutturato: una sola
+# gather per offerta porta con sé tutti i campi della riga
+CATEGORY_PARAMS_DTYPE = np.dtype([
+    ('disc_lo', 'i2'), ('disc_hi', 'i2'),
+    ('dur_lo', 'i2'), ('dur_hi', 'i2'),
+    ('uses_lo', 'i4'), ('uses_hi', 'i4'),
+])
+CATEGORY_PARAMS = np.array(
+    [(p.disc_lo, p.disc_hi, p.dur_lo, p.dur_hi, p.uses_lo, p.uses_hi) for p in _PROFILES],
+    dtype=CATEGORY_PARAMS_DTYPE
+)
+# Probabilità di offerta per categoria, passate come array al filtro SQL
+CATEGORY_PROB_NAMES = list(_CATEGORY_NAMES)
+CATEGORY_PROB_VALUES = [CATEGORY_TABLE[name].prob for name in _CATEGORY_NAMES]
+# Template descrizioni come (ha_placeholder, testo) in un'unica lista piatta:
+# le descrizioni della categoria i stanno in DESC_FLAT[DESC_OFFSETS[i]:DESC_OFFSETS[i + 1]].
+# La maggior parte non ha placeholder e può essere usata senza alcuna sostituzione
+DESC_FLAT = [
+    ('{' in desc, desc)
+    for p in _PROFILES for desc in p.descriptions
+]
+DESC_OFFSETS = np.cumsum([0] + [len(p.descriptions) for p in _PROFILES])
+DESC_LENS = np.diff(DESC_OFFSETS)
+
+def _pick_offer_fields(cat_idx: np.ndarray, rng: np.random.Generator) -> tuple:
+    """
+    Estrae in blocco i campi numerici di len(cat_idx) offerte.
+    
+    Restituisce array int32 di sconti, durate, usi massimi, indici in DESC_FLAT
+    e indici fascia d'età (-1 = nessun targeting età).
+    """
+    n = len(cat_idx)
+    
+    # Un'estrazione per colonna, con i range presi dai parametri per categoria
+    params = CATEGORY_PARAMS[cat_idx]
+    discounts = rng.integers(params['disc_lo'], params['disc_hi'] + 1, dtype=np.int32)
+    durations = rng.integers(params['dur_lo'], params['dur_hi'] + 1, dtype=np.int32)
+    max_uses = rng.integers(params['uses_lo'], params['uses_hi'] + 1, dtype=np.int32)
+    desc_idx = (DESC_OFFSETS[cat_idx] + rng.integers(0, DESC_LENS[cat_idx])).astype(np.int32)
+    age_idx = rng.integers(0, len(AGE_RANGES), n, dtype=np.int32)
+    age_idx[rng.random(n) >= AGE_TARGETING_PROBABILITY] = -1
+    
+    return discounts, durations, max_uses, desc_idx, age_idx
 
 # ===== SERVIZIO OFFERTE AUTONOMO =====
 class AirflowOffersService:
     """Servizio offerte integrato per Airflow - versione autonoma."""
     
-    def __init__(self, postgres_config: Dict[str, Any]):
-        self.postgres_config = postgres_config
+    def __init__(self):
+        self._conn = None
         
     def get_connection(self):
-        """Ottiene connessione PostgreSQL."""
-        return psycopg2.connect(**self.postgres_config)
+        """Ottiene una connessione dal pool, riutilizzata tra le chiamate del servizio."""
+        if self._conn is not None and self._conn.closed:
+            self.close()
+        if self._conn is None:
+            self._conn = _get_pool().getconn()
+        return self._conn
     
-    def generate_offers_for_all_shops(self) -> Dict[str, int]:
-        """Genera offerte per tutti i negozi nel database."""
-        total_offers = 0
-        shops_processed = 0
-        categories_stats = {}
-        
+    def close(self) -> None:
+        """Restituisce al pool la connessione mantenuta dal servizio."""
+        if self._conn is not None:
+            _get_pool().putconn(self._conn)
+        self._conn = None
+    
+    def generate_for_shard(self, shard: int, num_shards: int = OFFERS_CHUNKS) -> Dict[str, Any]:
+        """Genera offerte per i negozi con shop_id % num_shards == shard."""
         try:
             with self.get_connection() as conn:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    # Recupera tutti i negozi
-                    cur.execute("""
-                        SELECT shop_id, shop_name, category 
-                        FROM shops 
-                        WHERE category IS NOT NULL 
-                          AND category != '' 
-                          AND category != 'Non specificato'
-                    """)
-                    shops = cur.fetchall()
-                    
-                    logger.info(f"🏪 Trovati {len(shops)} negozi validi per generare offerte")
-                    
-                    for shop in shops:
-                        shops_processed += 1
-                        category = shop['category'].lower().strip()
-                        
-                        # Traccia statistiche per categoria
-                        if category not in categories_stats:
-                            categories_stats[category] = {'total': 0, 'with_offers': 0}
-                        categories_stats[category]['total'] += 1
-                        
-                        offers = self._generate_offers_for_shop(
-                            shop['shop_id'], shop['shop_name'], category
-                        )
-                        
-                        if offers:
-                            inserted = self._insert_offers(offers)
-                            total_offers += inserted
-                            if inserted > 0:
-                                categories_stats[category]['with_offers'] += 1
-                                logger.debug(f"✅ {shop['shop_name']} ({category}): {inserted} offerte")
-                        else:
-                            logger.debug(f"⏭️ {shop['shop_name']}: saltato per probabilità")
-                    
-                    # Log statistiche per categoria
-                    logger.info("📊 STATISTICHE OFFERTE PER CATEGORIA:")
-                    for cat, stats in sorted(categories_stats.items(), key=lambda x: x[1]['total'], reverse=True)[:10]:
-                        coverage = (stats['with_offers'] / stats['total'] * 100) if stats['total'] > 0 else 0
-                        logger.info(f"   {cat}: {stats['with_offers']}/{stats['total']} ({coverage:.1f}%)")
+                with conn.cursor() as cur:
+                    result = self._generate(cur, shard, num_shards)
         
         except Exception as e:
             logger.error(f"❌ Errore generazione offerte: {e}")
             raise
         
+        log_categories_stats(result['categories_stats'])
+        return result
+    
+    def eligible_shard_counts(self, num_shards: int = OFFERS_CHUNKS) -> Dict[int, int]:
+        """Conta i negozi idonei a ricevere nuove offerte per ogni shard (shop_id % num_shards)."""
+        with self.get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT s.shop_id %% %s AS shard, COUNT(*)
+                    FROM shops s
+                    WHERE {ELIGIBLE_SHOPS_FILTER}
+                    GROUP BY 1
+                """, (num_shards,))
+                return dict(cur.fetchall())
+    
+    def _generate(self, cur, shard: int, num_shards: int = OFFERS_CHUNKS) -> Dict[str, Any]:
+        """Genera e inserisce le offerte dello shard usando il cursore fornito."""
+        # Totali per categoria contati nel DB: il filtro di probabilità avviene
+        # in SQL, quindi i negozi scartati non arrivano mai a Python
+        cur.execute(f"""
+            SELECT LOWER(TRIM(s.category)), COUNT(*)
+            FROM shops s
+            WHERE {ELIGIBLE_SHOPS_FILTER}
+              AND s.shop_id %% %s = %s
+            GROUP BY 1
+        """, (num_shards, shard))
+        categories_stats = {
+            category: {'total': total, 'with_offers': 0} for category, total in cur.fetchall()
+        }
+        
+        query = f"""
+            SELECT s.shop_id, s.shop_name, LOWER(TRIM(s.category))
+            FROM shops s
+            LEFT JOIN unnest(%s::text[], %s::float8[]) AS cp(category, prob)
+              ON cp.category = LOWER(TRIM(s.category))
+            WHERE {ELIGIBLE_SHOPS_FILTER}
+              AND s.shop_id %% %s = %s
+              AND random() < COALESCE(cp.prob, %s)
+        """
+        params = (CATEGORY_PROB_NAMES, CATEGORY_PROB_VALUES, num_shards, shard, DEFAULT_PROFILE.prob)
+        
+        # Cursore server-side: i negozi estratti arrivano a blocchi di SHOPS_FETCH_SIZE
+        # righe invece di essere materializzati tutti in memoria; le offerte di ogni
+        # blocco vengono scritte prima di leggere il successivo
+        total_offers = 0
+        with cur.connection.cursor(name='shops_stream') as shops_cur:
+            shops_cur.execute(query, params)
+            for pending in self._pending_batches(shops_cur):
+                total_offers += self._flush_offers(pending, cur, categories_stats)
+        shops_processed = sum(stats['total'] for stats in categories_stats.values())
+        
+        logger.info(f"🏪 Trovati {shops_processed} negozi validi senza offerte attive")
+        
         return {
             'total_offers': total_offers,
             'shops_processed': shops_processed,
             'categories_stats': categories_stats
         }
     
-    def _generate_offers_for_shop(self, shop_id: int, shop_name: str, category: str) -> List[Dict]:
-        """Genera offerte per un singolo negozio."""
-        # Normalizza categoria
-        category_clean = category.lower().strip()
+    def _pending_batches(self, shops_cur):
+        """Decide quante offerte creare per ogni negozio estratto e le restituisce un blocco di fetch alla volta."""
+        # Una riga (shop_id, shop_name, categoria, indice categoria) per ogni offerta
+        # da creare: l'indice è risolto una sola volta per negozio, con le categorie
+        # sconosciute già mappate sul profilo di default. Le offerte di uno stesso
+        # negozio finiscono sempre nello stesso blocco
+        rng = np.random.default_rng()
+        while True:
+            rows = shops_cur.fetchmany(SHOPS_FETCH_SIZE)
+            if not rows:
+                break
+            
+            # Numero di offerte estratto per l'intero blocco
+            num_offers = rng.integers(MIN_OFFERS_PER_SHOP, MAX_OFFERS_PER_SHOP + 1, size=len(rows))
+            
+            pending = []
+            for (shop_id, shop_name, category), n in zip(rows, num_offers.tolist()):
+                cat = CAT_TO_IDX.get(category, DEFAULT_CATEGORY_IDX)
+                pending.extend([(shop_id, shop_name, category, cat)] * n)
+            
+            yield pending
+    
+    def _flush_offers(self, pending: List[tuple], cur,
+                      categories_stats: Dict[str, Dict[str, int]]) -> int:
+        """Genera e inserisce un blocco di offerte; restituisce quante ne sono state inserite."""
+        offers = self._create_random_offers(pending)
+        inserted_shop_ids = self._insert_offers(offers, cur)
+        
+        # Copertura per categoria calcolata sulle offerte effettivamente inserite.
+        # I totali vengono da uno statement separato (snapshot diverso in READ
+        # COMMITTED): un negozio inserito nel frattempo può avere una categoria
+        # assente dal dizionario
+        shop_categories = {shop_id: category for shop_id, _, category, _ in pending}
+        for shop_id in set(inserted_shop_ids):
+            stats = categories_stats.setdefault(shop_categories[shop_id], {'total': 0, 'with_offers': 0})
+            stats['with_offers'] += 1
         
-        # Verifica probabilità
-        probability = CATEGORY_OFFER_PROBABILITY.get(category_clean, 0.5)
-        if random.random() > probability:
+        return len(inserted_shop_ids)
+    
+    def _create_random_offers(self, pending: List[tuple]) -> List[Dict]:
+        """Crea in blocco le offerte casuali, estraendo ogni campo con numpy."""
+        n = len(pending)
+        if n == 0:
             return []
         
-        # Numero casuale di offerte
-        num_offers = random.randint(MIN_OFFERS_PER_SHOP, MAX_OFFERS_PER_SHOP)
-        offers = []
+        cat_idx = np.fromiter(
+            (cat for _, _, _, cat in pending),
+            dtype=np.intp, count=n
+        )
+        discounts, durations, max_uses, desc_idx, age_idx = (
+            column.tolist() for column in _pick_offer_fields(cat_idx, np.random.default_rng())
+        )
         
-        for i in range(num_offers):
-            offer = self._create_random_offer(shop_id, shop_name, category_clean)
-            if offer:
-                offers.append(offer)
+        # Scadenze calcolate una volta per ogni durata possibile, non per offerta
+        today = date.today()
+        valid_until_by_days = [today + timedelta(days=d) for d in range(int(CATEGORY_PARAMS['dur_hi'].max()) + 1)]
         
-        return offers
-    
-    def _create_random_offer(self, shop_id: int, shop_name: str, category: str) -> Optional[Dict]:
-        """Crea una singola offerta casuale."""
-        try:
-            # Sconto basato su categoria
-            discount_range = CATEGORY_DISCOUNT_RANGES.get(category, DEFAULT_DISCOUNT_RANGE)
-            discount = random.randint(discount_range[0], discount_range[1])
-            
-            # Durata basata su categoria
-            duration_range = CATEGORY_OFFER_DURATION.get(category, DEFAULT_DURATION_RANGE)
-            duration_days = random.randint(duration_range[0], duration_range[1])
-            
-            # Date validità
-            valid_from = date.today()
-            valid_until = valid_from + timedelta(days=duration_days)
-            
-            # Descrizione
-            descriptions = CATEGORY_DESCRIPTIONS.get(category, [
-                f"Offerta speciale da {shop_name}!",
-                f"Sconto del {discount}% per te!",
-                f"Promozione esclusiva: approfitta ora!"
-            ])
-            description = random.choice(descriptions)
-            
-            # Sostituisci placeholder se presenti
-            description = description.replace("{discount}", str(discount))
-            description = description.replace("{shop_name}", shop_name)
-            
-            # Usi massimi
-            max_uses_range = CATEGORY_MAX_USES.get(category, DEFAULT_MAX_USES_RANGE)
-            max_uses = random.randint(max_uses_range[0], max_uses_range[1])
-            
-            # Targeting età casuale (30% probabilità)
-            min_age, max_age = None, None
-            if random.random() < 0.3:
-                age_ranges = [(18, 30), (25, 45), (35, 65), (50, 75)]
-                min_age, max_age = random.choice(age_ranges)
+        desc_flat = DESC_FLAT
+        age_ranges = AGE_RANGES
+        offers = []
+        append = offers.append
+        for i, (shop_id, shop_name, _, _) in enumerate(pending):
+            discount = discounts[i]
+            has_placeholder, description = desc_flat[desc_idx[i]]
+            if has_placeholder:
+                description = description.format_map({'discount': discount, 'shop_name': shop_name})
+            min_age, max_age = age_ranges[age_idx[i]] if age_idx[i] >= 0 else (None, None)
             
-            return {
+            append({
                 'shop_id': shop_id,
                 'discount_percent': discount,
                 'description': description,
                 'offer_type': 'percentage',
-                'valid_from': valid_from,
-                'valid_until': valid_until,
+                'valid_from': today,
+                'valid_until': valid_until_by_days[durations[i]],
                 'is_active': True,
-                'max_uses': max_uses,
+                'max_uses': max_uses[i],
                 'current_uses': 0,
                 'min_age': min_age,
-                'max_age': max_age,
-                'target_categories': None
-            }
-            
-        except Exception as e:
-            logger.error(f"❌ Errore creazione offerta per negozio {shop_id}: {e}")
-            return None
+                'max_age': max_age
+            })
+        
+        return offers
     
-    def _insert_offers(self, offers: List[Dict]) -> int:
-        """Inserisce le offerte nel database."""
+    def _insert_offers(self, offers: List[Dict], cur) -> List[int]:
+        """Inserisce le offerte con un solo INSERT da unnest(); restituisce lo shop_id di ogni riga inserita."""
         if not offers:
-            return 0
+            return []
         
-        inserted_count = 0
+        # Una lista per colonna: l'intero blocco viaggia come 11 array parametri,
+        # senza limiti sul numero di righe per statement.
+        # target_categories non è valorizzato dal DAG e resta al default NULL
+        columns = [[o[key] for o in offers] for key in OFFER_INSERT_COLUMNS]
         
-        try:
-            with self.get_connection() as conn:
-                with conn.cursor() as cur:
-                    for offer in offers:
-                        try:
-                            cur.execute("""
-                                INSERT INTO offers (
-                                    shop_id, discount_percent, description, offer_type,
-                                    valid_from, valid_until, is_active, max_uses, current_uses,
-                                    min_age, max_age, target_categories
-                                ) VALUES (
-                                    %(shop_id)s, %(discount_percent)s, %(description)s, %(offer_type)s,
-                                    %(valid_from)s, %(valid_until)s, %(is_active)s, %(max_uses)s, %(current_uses)s,
-                                    %(min_age)s, %(max_age)s, %(target_categories)s
-                                ) ON CONFLICT DO NOTHING
-                            """, offer)
-                            
-                            if cur.rowcount > 0:
-                                inserted_count += 1
-                            
-                        except Exception as e:
-                            logger.error(f"❌ Errore inserimento singola offerta: {e}")
-                            conn.rollback()
-                            continue
-                    
-                    conn.commit()
-                    
-        except Exception as e:
-            logger.error(f"❌ Errore inserimento batch offerte: {e}")
-            raise
+        cur.execute(f"""
+            INSERT INTO offers ({', '.join(OFFER_INSERT_COLUMNS)})
+            SELECT * FROM unnest(
+                %s::int[], %s::int[], %s::text[], %s::varchar[],
+                %s::date[], %s::date[], %s::bool[], %s::int[], %s::int[],
+                %s::int[], %s::int[]
+            )
+            ON CONFLICT DO NOTHING
+            RETURNING shop_id
+        """, columns)
         
-        return inserted_count
+        return [row[0] for row in cur.fetchall()]
     
     def cleanup_expired_offers(self) -> int:
         """Disattiva le offerte scadute."""
@@ -483,237 +688,389 @@ class AirflowOffersService:
                         WHERE is_active = true 
                           AND valid_until < CURRENT_DATE
                     """)
-                    
                     updated_count = cur.rowcount
-                    conn.commit()
-                    
-                    if updated_count > 0:
-                        logger.info(f"🧹 Disattivate {updated_count} offerte scadute")
-                    
-                    return updated_count
+            
+            if updated_count > 0:
+                logger.info(f"🧹 Disattivate {updated_count} offerte scadute")
+            return updated_count
                     
         except Exception as e:
             logger.error(f"❌ Errore cleanup offerte scadute: {e}")
             return 0
 
+def log_categories_stats(categories_stats: Dict[str, Dict[str, int]]) -> None:
+    """Logga la copertura offerte delle 10 categorie con più negozi."""
+    logger.info("📊 STATISTICHE OFFERTE PER CATEGORIA:")
+    for cat, stats in heapq.nlargest(10, categories_stats.items(), key=lambda x: x[1]['total']):
+        coverage = (stats['with_offers'] / stats['total'] * 100) if stats['total'] > 0 else 0
+        logger.info(f"   {cat}: {stats['with_offers']}/{stats['total']} ({coverage:.1f}%)")
+
 # ===== TASK FUNCTIONS =====
-def extract_data(**kwargs):
-    """Estrae dati dei negozi da Overpass API."""
+def _overpass_payload_ok(path: str) -> bool:
+    """True se il file Overpass contiene almeno un elemento e nessun 'remark' di errore."""
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            has_elements = False
+            for prefix, event, _ in ijson.parse(f):
+                if prefix == 'remark':
+                    return False
+                if prefix == 'elements.item' and event == 'start_map':
+                    has_elements = True
+            return has_elements
+        data = orjson.loads(f.read()) if orjson else json.load(f)
+    return 'remark' not in data and bool(data.get('elements'))
+
+def _overpass_cache_path() -> str:
+    """File di cache della risposta Overpass, identificato dall'hash della query."""
+    key = hashlib.sha256(OVERPASS_QUERY.encode()).hexdigest()
+    return os.path.join(OVERPASS_DATA_DIR, f"overpass_{key}.json")
+
+def _cached_overpass_payload() -> Optional[str]:
+    """Restituisce il file Overpass in cache se più recente di OVERPASS_CACHE_TTL, altrimenti None."""
+    path = _overpass_cache_path()
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < OVERPASS_CACHE_TTL:
+        logger.info(f"♻️ Risposta Overpass in cache, riuso {path}")
+        return path
+    return None
+
+def extract_data() -> Optional[str]:
+    """Scarica i negozi da Overpass API nella cache; restituisce il file con la risposta grezza."""
     logger.info("🔍 Inizio estrazione dati da Overpass API...")
     
-    overpass_query = """
-    [out:json][timeout:25];
-    area["name"="Milano"]->.searchArea;
-    (
-      node["shop"](area.searchArea);
-      way["shop"](area.searchArea);
-      relation["shop"](area.searchArea);
-    );
-    out center;
-    """
-    
+    path = _overpass_cache_path()
+    tmp_path = f"{path}.{os.getpid()}.part"
     try:
-        url = "http://overpass-api.de/api/interpreter"
-        response = requests.post(url, data={'data': overpass_query}, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        # Si salva la risposta così com'è, a blocchi man mano che arriva;
+        # il file finale compare solo a download completato
+        os.makedirs(OVERPASS_DATA_DIR, exist_ok=True)
+        size = 0
+        with _SESSION.post(OVERPASS_URL, data={'data': OVERPASS_QUERY}, timeout=OVERPASS_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=OVERPASS_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
         
-        elements = data.get("elements", [])
-        logger.info(f"✅ Estratti {len(elements)} elementi da Overpass API")
-        return elements
+        # Errori runtime di Overpass (timeout, memoria) arrivano con HTTP 200:
+        # una risposta vuota o troncata non va messa in cache per 6 ore
+        if not _overpass_payload_ok(tmp_path):
+            logger.error("❌ Risposta Overpass incompleta (remark o nessun elemento), scartata")
+            return None
+        os.replace(tmp_path, path)
+        
+        logger.info(f"✅ Risposta Overpass salvata in {path} ({size} byte)")
+        return path
         
     except requests.exceptions.RequestException as e:
         logger.error(f"❌ Errore chiamata Overpass API: {e}")
-        # Fallback: restituisci lista vuota per non bloccare il pipeline
-        return []
+        # Fallback: nessun file, il transform prosegue a vuoto senza bloccare il pipeline
+        return None
     except Exception as e:
         logger.error(f"❌ Errore generico estrazione: {e}")
-        return []
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Spazi e trattini nei valori shop= diventano underscore, come nelle chiavi CATEGORY_*
+_CATEGORY_SEP_RE = re.compile(r"[\s\-]+")
+
+def _normalize_category(value: str) -> str:
+    """Normalizza un valore shop= OSM: primo valore di una lista 'a;b', minuscolo, underscore."""
+    value = value.split(";", 1)[0].strip().lower()
+    return _CATEGORY_SEP_RE.sub("_", value)
+
+def _transform_element(element: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Normalizza un elemento Overpass in un negozio; None se senza coordinate valide."""
+    # Estrai coordinate
+    if element.get("type") == "node":
+        lat = element.get("lat")
+        lon = element.get("lon")
+    else:
+        center = element.get("center")
+        if center is None:
+            return None
+        lat = center.get("lat")
+        lon = center.get("lon")
+    
+    # Verifica coordinate valide
+    if not lat or not lon:
+        return None
+    
+    tags = element.get("tags") or {}
+    
+    # Pulisci e normalizza i dati
+    name = tags.get("name", "").strip() or f"Negozio {tags.get('shop', 'Generico')}"
+    address = tags.get("addr:full", "").strip() or tags.get("addr:street", "Non specificato").strip()
+    category = _normalize_category(tags.get("shop", "")) or "generico"
+    
+    return {
+        "name": name[:255],  # Limita lunghezza
+        "address": address[:500],
+        "category": category,
+        "lon": float(lon),
+        "lat": float(lat)
+    }
 
-def transform_data(**kwargs):
+def _try_transform_element(element: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Come _transform_element, ma un elemento malformato viene loggato e scartato."""
+    try:
+        return _transform_element(element)
+    except Exception as e:
+        logger.error(f"❌ Errore trasformazione elemento: {e}")
+        return None
+
+def _iter_elements(path: str):
+    """Restituisce uno alla volta gli elementi del file Overpass (in streaming se c'è ijson)."""
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.items(f, 'elements.item', use_float=True)
+        else:
+            data = orjson.loads(f.read()) if orjson else json.load(f)
+            yield from data.get("elements", [])
+
+def transform_data(path: Optional[str]) -> List[Dict[str, Any]]:
     """Trasforma i dati estratti in formato adatto per il database."""
     logger.info("🔄 Inizio trasformazione dati...")
     
-    ti = kwargs['ti']
-    raw_data = ti.xcom_pull(task_ids='extract_data')
-    
-    if not raw_data:
+    if not path or not os.path.exists(path):
         logger.warning("⚠️ Nessun dato da trasformare")
         return []
     
-    transformed = []
-    skipped = 0
+    results = [_try_transform_element(element) for element in _iter_elements(path)]
+    total = len(results)
     
-    for element in raw_data:
-        try:
-            # Estrai coordinate
-            if element.get("type") == "node":
-                lat = element.get("lat")
-                lon = element.get("lon")
-            elif "center" in element:
-                lat = element["center"].get("lat")
-                lon = element["center"].get("lon")
-            else:
-                skipped += 1
-                continue
-            
-            # Verifica coordinate valide
-            if not lat or not lon:
-                skipped += 1
-                continue
-                
-            tags = element.get("tags", {})
-            
-            # Pulisci e normalizza i dati
-            name = tags.get("name", "").strip()
-            if not name:
-                name = f"Negozio {tags.get('shop', 'Generico')}"
-            
-            address = tags.get("addr:full", "").strip()
-            if not address:
-                address = tags.get("addr:street", "Non specificato").strip()
-            
-            category = tags.get("shop", "").strip().lower()
-            if not category:
-                category = "generico"
-            
-            transformed.append({
-                "name": name[:255],  # Limita lunghezza
-                "address": address[:500],
-                "category": category,
-                "geom": f"POINT({lon} {lat})"
-            })
-            
-        except Exception as e:
-            logger.error(f"❌ Errore trasformazione elemento: {e}")
-            skipped += 1
-            continue
+    if total == 0:
+        logger.warning("⚠️ Nessun dato da trasformare")
+        return []
+    
+    # Overpass può restituire più volte lo stesso negozio: si tiene la prima
+    # occorrenza per (nome, posizione al micro-grado), che scorrendo al contrario
+    # è l'ultima ad essere assegnata. L'indirizzo non basta come chiave: negozi
+    # della stessa catena senza indirizzo finirebbero fusi in uno solo
+    seen = {
+        (shop["name"], round(shop["lon"], 6), round(shop["lat"], 6)): shop
+        for shop in reversed(results) if shop is not None
+    }
+    skipped = results.count(None)
     
-    logger.info(f"✅ Trasformati {len(transformed)} negozi, saltati {skipped}")
+    transformed = list(seen.values())
+    valid = total - skipped
+    duplicates = valid - len(transformed)
+    dup_rate = (duplicates / valid * 100) if valid else 0
+    logger.info(f"✅ Trasformati {len(transformed)} negozi, saltati {skipped}, "
+                f"duplicati rimossi {duplicates} ({dup_rate:.1f}%)")
     return transformed
 
-def load_data(**kwargs):
+def load_data(shops: List[Dict[str, Any]]) -> int:
     """Carica i dati dei negozi nel database."""
     logger.info("💾 Inizio caricamento dati nel database...")
     
-    ti = kwargs['ti']
-    shops = ti.xcom_pull(task_ids='transform_data')
-    
     if not shops:
         logger.warning("⚠️ Nessun negozio da inserire")
         return 0
     
+    # Serializza i negozi in CSV in memoria per il COPY
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for shop in shops:
+        writer.writerow((shop["name"], shop["address"], shop["category"], shop["lon"], shop["lat"]))
+    buf.seek(0)
+    
     try:
-        conn = psycopg2.connect(**POSTGRES_CONFIG)
-        cur = conn.cursor()
-        cur.execute("SET search_path TO public;")
-        
-        insert_query = """
-          INSERT INTO shops (shop_name, address, category, geom)
-          VALUES (%s, %s, %s, ST_GeomFromText(%s, 4326))
-          ON CONFLICT DO NOTHING
-          RETURNING shop_id;
-        """
-        
-        inserted_count = 0
-        for shop in shops:
+        with pg_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SET search_path TO public;")
+            # Il caricamento è idempotente e rieseguibile: il commit non attende
+            # il flush del WAL su disco
+            cur.execute("SET LOCAL synchronous_commit = off;")
+            
             try:
-                cur.execute(insert_query, (
-                    shop["name"],
-                    shop["address"],
-                    shop["category"],
-                    shop["geom"]
-                ))
-                if cur.fetchone():
-                    inserted_count += 1
-            except Exception as e:
-                logger.error(f"❌ Errore inserimento negozio {shop['name']}: {e}")
+                # Staging temporaneo: COPY in blocco, poi un solo INSERT ... SELECT
+                cur.execute("""
+                  CREATE TEMP TABLE shops_stage (
+                    name text, address text, category text, lon float8, lat float8
+                  ) ON COMMIT DROP;
+                """)
+                # csv.writer scrive le stringhe vuote senza virgolette: FORCE_NOT_NULL
+                # le mantiene '' invece di NULL, come faceva l'INSERT per riga
+                cur.copy_expert(
+                    "COPY shops_stage FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (name, address, category))",
+                    buf
+                )
+                # Solo i negozi non ancora presenti (stesso nome, stessa posizione):
+                # shops ha solo la chiave seriale, quindi ON CONFLICT non scarterebbe
+                # nulla. ~= confronta i bounding box float4 dell'indice GIST, con una
+                # tolleranza di circa 0,1-0,4 m: non è la chiave round(lon/lat, 6)
+                # della deduplica in transform_data, ma resta sotto il metro
+                cur.execute("""
+                  INSERT INTO shops (shop_name, address, category, geom)
+                  SELECT st.name, st.address, st.category, ST_SetSRID(ST_MakePoint(st.lon, st.lat), 4326)
+                  FROM shops_stage st
+                  WHERE NOT EXISTS (
+                    SELECT 1 FROM shops s
+                    WHERE s.geom ~= ST_SetSRID(ST_MakePoint(st.lon, st.lat), 4326)
+                      AND s.shop_name = st.name
+                  )
+                  RETURNING shop_id;
+                """)
+                inserted_count = len(cur.fetchall())
+                conn.commit()
+            except Exception:
                 conn.rollback()
-                continue
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+                raise
+            finally:
+                cur.close()
         
         logger.info(f"✅ Inseriti {inserted_count} nuovi negozi nel database")
         return inserted_count
         
     except Exception as e:
-        logger.error(f"❌ Errore connessione database: {e}")
+        logger.error(f"❌ Errore caricamento negozi: {e}")
         raise
 
-def generate_offers(**kwargs):
-    """Genera offerte casuali per tutti i negozi."""
-    logger.info("🎯 Inizio generazione offerte...")
+def _overpass_shop_count() -> Optional[int]:
+    """Conta gli elementi della query negozi con 'out count'; None se il conteggio non è disponibile."""
+    try:
+        response = _SESSION.post(OVERPASS_URL, data={'data': OVERPASS_COUNT_QUERY}, timeout=OVERPASS_TIMEOUT)
+        response.raise_for_status()
+        return int(response.json()["elements"][0]["tags"]["total"])
+    except (requests.exceptions.RequestException, LookupError, ValueError) as e:
+        logger.warning(f"⚠️ Conteggio Overpass non disponibile: {e}")
+        return None
+
+def _shops_unchanged(shop_count: Optional[int]) -> bool:
+    """True se l'ultimo caricamento recente aveva lo stesso numero di negozi."""
+    if shop_count is None:
+        return False
+    try:
+        with open(OVERPASS_STATE_PATH) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (state.get('count') == shop_count
+            and time.time() - state.get('loaded_at', 0) < OVERPASS_REFRESH_MAX_AGE)
+
+def _save_shops_state(shop_count: Optional[int]) -> None:
+    """Registra il numero di negozi dell'ultimo caricamento completato."""
+    if shop_count is None:
+        return
+    os.makedirs(OVERPASS_DATA_DIR, exist_ok=True)
+    with open(OVERPASS_STATE_PATH, 'w') as f:
+        json.dump({'count': shop_count, 'loaded_at': time.time()}, f)
+
+def etl_shops(**kwargs):
+    """Estrae, trasforma e carica i negozi in un unico task, senza passaggi via XCom."""
+    # Retry e riesecuzioni entro OVERPASS_CACHE_TTL riusano il file in cache
+    # senza interrogare Overpass, nemmeno per il conteggio
+    path = _cached_overpass_payload()
+    shop_count = None
+    if path is None:
+        # Pre-check leggero: se su Overpass il numero di negozi non è cambiato
+        # dall'ultimo caricamento recente non si scarica il payload completo
+        shop_count = _overpass_shop_count()
+        if _shops_unchanged(shop_count):
+            logger.info(f"⏭️ Negozi invariati su Overpass ({shop_count}), ETL saltato")
+            return 0
+        path = extract_data()
+    
+    shops = transform_data(path)
+    inserted_count = load_data(shops)
+    # Lo stato si registra solo se il payload è stato scaricato insieme al conteggio
+    if shops:
+        _save_shops_state(shop_count)
+    return inserted_count
+
+def plan_offers(**kwargs):
+    """Disattiva le offerte scadute e sceglie gli shard di negozi idonei da elaborare."""
+    logger.info("🗂️ Pianificazione generazione offerte...")
     
+    ti = kwargs['ti']
+    offers_service = AirflowOffersService()
     try:
-        offers_service = AirflowOffersService(POSTGRES_CONFIG)
-        
-        # Cleanup offerte scadute
         expired_count = offers_service.cleanup_expired_offers()
-        
-        # Genera nuove offerte
-        result = offers_service.generate_offers_for_all_shops()
-        
-        logger.info(f"✅ Generazione completata:")
-        logger.info(f"   📊 Negozi processati: {result['shops_processed']}")
-        logger.info(f"   🎁 Nuove offerte: {result['total_offers']}")
-        logger.info(f"   🧹 Offerte scadute rimosse: {expired_count}")
-        
-        return {
-            'expired_cleaned': expired_count,
-            'new_offers': result['total_offers'],
-            'shops_processed': result['shops_processed'],
-            'categories_stats': result['categories_stats']
-        }
-        
+        shard_counts = offers_service.eligible_shard_counts(OFFERS_CHUNKS)
+    finally:
+        offers_service.close()
+    
+    ti.xcom_push(key='expired_cleaned', value=expired_count)
+    
+    # Shard per shop_id % OFFERS_CHUNKS: in XCom viaggiano solo gli indici,
+    # ogni task seleziona da sé i propri negozi
+    shards = sorted(shard for shard, count in shard_counts.items() if count)
+    logger.info(f"✅ {sum(shard_counts.values())} negozi idonei divisi in {len(shards)} shard")
+    
+    # Ogni elemento è la lista op_args di un task mappato
+    return [[shard, OFFERS_CHUNKS] for shard in shards]
+
+def generate_offers_chunk(shard: int, num_shards: int, **kwargs):
+    """Genera offerte casuali per uno shard di negozi."""
+    logger.info(f"🎯 Generazione offerte per lo shard {shard}/{num_shards}...")
+    
+    offers_service = AirflowOffersService()
+    try:
+        return offers_service.generate_for_shard(shard, num_shards)
     except Exception as e:
         logger.error(f"❌ Errore nella generazione delle offerte: {e}")
         raise
+    finally:
+        offers_service.close()
+
+def generate_offers(**kwargs):
+    """Aggrega i risultati dei task di generazione offerte."""
+    ti = kwargs['ti']
+    expired_count = ti.xcom_pull(task_ids='plan_offers', key='expired_cleaned') or 0
+    chunk_results = ti.xcom_pull(task_ids='generate_offers_chunk') or []
+    
+    total_offers = 0
+    shops_processed = 0
+    categories_stats = {}
+    for result in chunk_results:
+        if not result:
+            continue
+        total_offers += result['total_offers']
+        shops_processed += result['shops_processed']
+        for cat, stats in result['categories_stats'].items():
+            merged = categories_stats.setdefault(cat, {'total': 0, 'with_offers': 0})
+            merged['total'] += stats['total']
+            merged['with_offers'] += stats['with_offers']
+    
+    log_categories_stats(categories_stats)
+    logger.info(f"✅ Generazione completata:")
+    logger.info(f"   📊 Negozi processati: {shops_processed}")
+    logger.info(f"   🎁 Nuove offerte: {total_offers}")
+    logger.info(f"   🧹 Offerte scadute rimosse: {expired_count}")
+    
+    return {
+        'expired_cleaned': expired_count,
+        'new_offers': total_offers,
+        'shops_processed': shops_processed,
+        'categories_stats': categories_stats
+    }
 
 def validate_data_quality(**kwargs):
     """Valida la qualità dei dati inseriti."""
     logger.info("✅ Inizio validazione qualità dati...")
     
     ti = kwargs['ti']
-    shops_inserted = ti.xcom_pull(task_ids='load_data') or 0
+    shops_inserted = ti.xcom_pull(task_ids='etl_shops') or 0
     offers_result = ti.xcom_pull(task_ids='generate_offers') or {}
     
     try:
-        conn = psycopg2.connect(**POSTGRES_CONFIG)
-        cur = conn.cursor()
-        
-        # Statistiche negozi
-        cur.execute("SELECT COUNT(*) FROM shops")
-        total_shops = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(DISTINCT category) FROM shops WHERE category IS NOT NULL")
-        unique_categories = cur.fetchone()[0]
-        
-        # Statistiche offerte
-        cur.execute("SELECT COUNT(*) FROM offers WHERE is_active = true")
-        active_offers = cur.fetchone()[0]
-        
-        cur.execute("""
-            SELECT COUNT(*) FROM shops s 
-            LEFT JOIN offers o ON s.shop_id = o.shop_id AND o.is_active = true
-            WHERE o.offer_id IS NULL
-        """)
-        shops_without_offers = cur.fetchone()[0]
-        
-        # Top categorie con offerte
-        cur.execute("""
-            SELECT s.category, 
-                   COUNT(s.shop_id) as total_shops,
-                   COUNT(o.offer_id) as shops_with_offers,
-                   ROUND(AVG(o.discount_percent), 1) as avg_discount
-            FROM shops s
-            LEFT JOIN offers o ON s.shop_id = o.shop_id AND o.is_active = true
-            GROUP BY s.category
-            ORDER BY total_shops DESC
-            LIMIT 10
-        """)
-        top_categories_with_offers = cur.fetchall()
+        with pg_connection() as conn:
+            # Statistiche pre-aggregate nella vista materializzata shop_offer_stats:
+            # il DAG la aggiorna, dashboard e report la leggono senza scansioni
+            with conn, conn.cursor() as cur:
+                cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY shop_offer_stats")
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT total_shops, unique_categories, active_offers,
+                           shops_without_offers, top_categories
+                    FROM shop_offer_stats
+                """)
+                (total_shops, unique_categories, active_offers,
+                 shops_without_offers, top_categories_with_offers) = cur.fetchone()
+        top_categories_with_offers = top_categories_with_offers or []
         
         # Report finale
         logger.info("=" * 60)
@@ -728,7 +1085,9 @@ def validate_data_quality(**kwargs):
         logger.info(f"📈 Coverage offerte: {((active_offers/total_shops)*100):.1f}%")
         
         logger.info("\n🔝 TOP 10 CATEGORIE CON STATISTICHE OFFERTE:")
-        for cat, total, with_offers, avg_discount in top_categories_with_offers:
+        for row in top_categories_with_offers:
+            cat, total = row['category'], row['total_shops']
+            with_offers, avg_discount = row['shops_with_offers'], row['avg_discount']
             coverage = (with_offers / total * 100) if total > 0 else 0
             avg_discount_str = f"{avg_discount}%" if avg_discount else "N/A"
             logger.info(f"   {cat:15} | {total:4} negozi | {with_offers:4} offerte | {coverage:5.1f}% | avg {avg_discount_str}")
@@ -768,11 +1127,6 @@ def validate_data_quality(**kwargs):
     except Exception as e:
         logger.error(f"❌ Errore validazione: {e}")
         raise
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
 
 # ===== DAG DEFINITION =====
 with DAG(
@@ -790,7 +1144,9 @@ with DAG(
     1. **Extract**: Scarica negozi da Overpass API (Milano)
     2. **Transform**: Pulisce e normalizza i dati (supporta categorie IT/EN)
     3. **Load**: Inserisce negozi in PostgreSQL
-    4. **Offers**: Genera offerte casuali per ogni negozio (configurazione multilingua)
+       (i passi 1-3 girano in un unico task `etl_shops`)
+    4. **Offers**: Genera offerte casuali per ogni negozio (configurazione multilingua),
+       in parallelo su shard di negozi (shop_id % N) limitati dal pool `postgres_writers`
     5. **Validate**: Controlla qualità dei dati e coverage offerte
     
     ### Caratteristiche
@@ -810,28 +1166,32 @@ with DAG(
     """
 ) as dag:
 
-    extract_task = PythonOperator(
-        task_id='extract_data',
-        python_callable=extract_data,
-        doc_md="Estrae dati negozi da Overpass API per Milano"
+    etl_shops_task = PythonOperator(
+        task_id='etl_shops',
+        python_callable=etl_shops,
+        doc_md="Estrae i negozi da Overpass API, li normalizza e li carica in PostgreSQL con PostGIS"
     )
 
-    transform_task = PythonOperator(
-        task_id='transform_data',
-        python_callable=transform_data,
-        doc_md="Trasforma e pulisce i dati per il database (supporto multilang)"
+    plan_offers_task = PythonOperator(
+        task_id='plan_offers',
+        python_callable=plan_offers,
+        doc_md="Disattiva offerte scadute e sceglie gli shard di negozi da elaborare"
     )
 
-    load_task = PythonOperator(
-        task_id='load_data',
-        python_callable=load_data,
-        doc_md="Carica i negozi in PostgreSQL con PostGIS"
-    )
+    # Un task per shard; il pool limita le connessioni concorrenti al DB
+    offers_chunk_tasks = PythonOperator.partial(
+        task_id='generate_offers_chunk',
+        python_callable=generate_offers_chunk,
+        pool=OFFERS_POOL,
+        pool_slots=1,
+        doc_md="Genera offerte casuali con configurazione IT/EN per uno shard di negozi"
+    ).expand(op_args=plan_offers_task.output)
 
     offers_task = PythonOperator(
         task_id='generate_offers',
         python_callable=generate_offers,
-        doc_md="Genera offerte casuali con configurazione IT/EN per categoria"
+        trigger_rule='none_failed',
+        doc_md="Aggrega i risultati della generazione offerte"
     )
 
     validate_task = PythonOperator(
@@ -841,4 +1201,4 @@ with DAG(
     )
 
     # Pipeline flow
-    extract_task >> transform_task >> load_task >> offers_task >> validate_task
\ No newline at end of file
+    etl_shops_task >> plan_offers_task >> offers_chunk_tasks >> offers_task >> validate_task
\ No newline at end of file
@@ -33,11 +33,15 @@ echo "Inizializzazione e upgrade del database Airflow..."
 su airflow -c "airflow db init" || true
 su airflow -c "airflow db upgrade"
 
-# 4) Attiva automaticamente il DAG 'etl_shops'
+# 4) Pool che limita le connessioni concorrenti verso postgres-postgis
+echo "Creo il pool Airflow postgres_writers..."
+su airflow -c "airflow pools set postgres_writers 4 'Task paralleli di scrittura su postgres-postgis'" || echo "Errore nella creazione del pool postgres_writers."
+
+# 5) Attiva automaticamente il DAG 'etl_shops'
 echo "Attivo automaticamente il DAG etl_shops (se presente)..."
 su airflow -c "airflow dags unpause etl_shops" || echo "DAG etl_shops già attivo o errore nell'unpause."
 
-# 5) Creazione automatica dell'utenza Admin in Airflow
+# 6) Creazione automatica dell'utenza Admin in Airflow
 echo "Creazione automatica dell'utenza Admin in Airflow..."
 su airflow -c "airflow users create \
   --username admin \
@@ -47,6 +51,6 @@ su airflow -c "airflow users create \
   --email admin@example.com \
   --password admin" || echo "Utente admin già esistente o errore nella creazione."
 
-# 6) Avvio dello Scheduler come utente 'airflow'
+# 7) Avvio dello Scheduler come utente 'airflow'
 echo "Avvio di Airflow Scheduler come utente 'airflow'..."
 exec su airflow -c "airflow scheduler"
@@ -42,6 +42,9 @@ CREATE TABLE IF NOT EXISTS shops (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Indice spaziale, usato anche dall'anti-join del caricamento giornaliero
+CREATE INDEX IF NOT EXISTS idx_shops_geom ON shops USING GIST (geom);
+
 -- Creazione tabella offers
 CREATE TABLE IF NOT EXISTS offers (
     offer_id SERIAL PRIMARY KEY,
@@ -75,6 +78,7 @@ CREATE TABLE IF NOT EXISTS offers (
 CREATE INDEX IF NOT EXISTS idx_offers_shop_active ON offers(shop_id, is_active);
 CREATE INDEX IF NOT EXISTS idx_offers_validity ON offers(valid_from, valid_until) WHERE is_active = true;
 CREATE INDEX IF NOT EXISTS idx_offers_discount ON offers(discount_percent) WHERE is_active = true;
+CREATE INDEX IF NOT EXISTS idx_offers_active_shop ON offers(shop_id, valid_until) WHERE is_active = true;
 
 -- Trigger per aggiornare updated_at
 CREATE OR REPLACE FUNCTION update_offers_updated_at()
@@ -94,6 +98,41 @@ CREATE TRIGGER trigger_offers_updated_at
 ALTER TABLE offers ADD CONSTRAINT IF NOT EXISTS chk_offers_valid_dates 
     CHECK (valid_until > valid_from);
 
+-- Statistiche negozi/offerte pre-aggregate (una riga), aggiornate dal DAG etl_shops
+CREATE MATERIALIZED VIEW IF NOT EXISTS shop_offer_stats AS
+WITH shop_stats AS (
+    SELECT COUNT(*) AS total_shops,
+           COUNT(DISTINCT category) AS unique_categories
+    FROM shops
+),
+offer_stats AS (
+    SELECT COUNT(*) AS active_offers FROM offers WHERE is_active = true
+),
+no_offer_stats AS (
+    SELECT COUNT(*) AS shops_without_offers FROM shops s
+    LEFT JOIN offers o ON s.shop_id = o.shop_id AND o.is_active = true
+    WHERE o.offer_id IS NULL
+),
+top_categories AS (
+    SELECT json_agg(t ORDER BY t.total_shops DESC) AS top_categories FROM (
+        SELECT s.category,
+               COUNT(s.shop_id) as total_shops,
+               COUNT(o.offer_id) as shops_with_offers,
+               ROUND(AVG(o.discount_percent), 1) as avg_discount
+        FROM shops s
+        LEFT JOIN offers o ON s.shop_id = o.shop_id AND o.is_active = true
+        GROUP BY s.category
+        ORDER BY total_shops DESC
+        LIMIT 10
+    ) t
+)
+SELECT 1 AS id, total_shops, unique_categories, active_offers,
+       shops_without_offers, top_categories, CURRENT_TIMESTAMP AS refreshed_at
+FROM shop_stats, offer_stats, no_offer_stats, top_categories;
+
+-- Indice univoco richiesto da REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS idx_shop_offer_stats_id ON shop_offer_stats(id);
+
 -- Commenti per documentazione
 COMMENT ON TABLE offers IS 'Offerte e promozioni disponibili per i negozi';
 COMMENT ON COLUMN offers.discount_percent IS 'Percentuale di sconto (1-50)';
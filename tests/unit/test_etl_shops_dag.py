@@ -0,0 +1,303 @@
+"""
+Unit tests for the etl_shops Airflow DAG helpers.
+The DAG module is loaded with a minimal stand-in for the airflow package,
+so the transform and offer-building logic can be tested without Airflow.
+"""
+import importlib.util
+import json
+import os
+import sys
+import types
+from datetime import date
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("psycopg2")
+
+DAG_PATH = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'airflow', 'dags', 'etl_shops.py'
+)
+
+
+class _FakeOperator:
+    """Accepts the PythonOperator calls made while the DAG is declared."""
+
+    def __init__(self, *args, **kwargs):
+        self.output = None
+
+    @classmethod
+    def partial(cls, **kwargs):
+        return cls()
+
+    def expand(self, **kwargs):
+        return self
+
+    def __rshift__(self, other):
+        return other
+
+
+class _FakeDAG:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture(scope="module")
+def etl(tmp_path_factory):
+    """Load the DAG module with airflow stubbed out."""
+    airflow = types.ModuleType("airflow")
+    airflow.DAG = _FakeDAG
+    operators = types.ModuleType("airflow.operators")
+    python_operator = types.ModuleType("airflow.operators.python_operator")
+    python_operator.PythonOperator = _FakeOperator
+    stubs = {
+        "airflow": airflow,
+        "airflow.operators": operators,
+        "airflow.operators.python_operator": python_operator,
+    }
+
+    with patch.dict(sys.modules, stubs), \
+            patch.dict(os.environ, {"AIRFLOW_HOME": str(tmp_path_factory.mktemp("airflow_home"))}):
+        spec = importlib.util.spec_from_file_location("etl_shops_dag", DAG_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+def _write_overpass(tmp_path, elements):
+    path = tmp_path / "overpass.json"
+    path.write_text(json.dumps({"elements": elements}))
+    return str(path)
+
+
+def _node(name, lon, lat, shop="bakery", street=None):
+    tags = {"shop": shop, "name": name}
+    if street:
+        tags["addr:street"] = street
+    return {"type": "node", "lon": lon, "lat": lat, "tags": tags}
+
+
+class TestTransformData:
+    """Unit tests for transform_data deduplication."""
+
+    def test_dedupe_keeps_first_occurrence(self, etl, tmp_path):
+        """Test duplicates at the same micro-degree position keep the first element."""
+        path = _write_overpass(tmp_path, [
+            _node("Forno", 9.1900001, 45.4600001, street="Via Roma"),
+            _node("Forno", 9.1900002, 45.4600002, street="Via Milano"),
+        ])
+
+        shops = etl.transform_data(path)
+
+        assert len(shops) == 1
+        assert shops[0]["address"] == "Via Roma"
+
+    def test_dedupe_keeps_distinct_positions_and_names(self, etl, tmp_path):
+        """Test shops differing by name or position are not merged."""
+        path = _write_overpass(tmp_path, [
+            _node("Forno", 9.19, 45.46),
+            _node("Forno", 9.191, 45.46),
+            _node("Pane", 9.19, 45.46),
+        ])
+
+        shops = etl.transform_data(path)
+
+        assert sorted((s["name"], s["lon"]) for s in shops) == [
+            ("Forno", 9.19), ("Forno", 9.191), ("Pane", 9.19)
+        ]
+
+    def test_missing_file_returns_empty(self, etl):
+        """Test a missing extract produces no shops."""
+        assert etl.transform_data(None) == []
+
+
+class TestNormalizeCategory:
+    """Unit tests for OSM shop= category normalisation."""
+
+    @pytest.mark.parametrize("raw, expected", [
+        ("Car Repair;tyres", "car_repair"),
+        ("  Ice-Cream ", "ice_cream"),
+        ("mobile  phone", "mobile_phone"),
+        ("bakery", "bakery"),
+        ("", ""),
+    ])
+    def test_normalize_category(self, etl, raw, expected):
+        """Test first list value is kept, lowercased, with separators as underscores."""
+        assert etl._normalize_category(raw) == expected
+
+    def test_transform_uses_normalized_category(self, etl, tmp_path):
+        """Test transformed shops carry the normalised category."""
+        path = _write_overpass(tmp_path, [_node("Officina", 9.19, 45.46, shop="Car Repair;tyres")])
+
+        shops = etl.transform_data(path)
+
+        assert shops[0]["category"] == "car_repair"
+
+
+class TestOfferFields:
+    """Unit tests for vectorised offer field extraction."""
+
+    def test_draws_stay_within_category_bounds(self, etl):
+        """Test every drawn field stays inside its category parameters."""
+        cat_idx = np.repeat(np.arange(len(etl.CATEGORY_PARAMS)), 50)
+        rng = np.random.default_rng(42)
+
+        discounts, durations, max_uses, desc_idx, age_idx = etl._pick_offer_fields(cat_idx, rng)
+
+        params = etl.CATEGORY_PARAMS[cat_idx]
+        assert np.all((discounts >= params['disc_lo']) & (discounts <= params['disc_hi']))
+        assert np.all((durations >= params['dur_lo']) & (durations <= params['dur_hi']))
+        assert np.all((max_uses >= params['uses_lo']) & (max_uses <= params['uses_hi']))
+        assert np.all(desc_idx >= etl.DESC_OFFSETS[cat_idx])
+        assert np.all(desc_idx < etl.DESC_OFFSETS[cat_idx + 1])
+        assert np.all((age_idx >= -1) & (age_idx < len(etl.AGE_RANGES)))
+
+
+class TestInsertOffers:
+    """Unit tests for the unnest() offer insert."""
+
+    # Expected array cast for each column in OFFER_INSERT_COLUMNS
+    EXPECTED_CASTS = {
+        'shop_id': 'int', 'discount_percent': 'int', 'description': 'text',
+        'offer_type': 'varchar', 'valid_from': 'date', 'valid_until': 'date',
+        'is_active': 'bool', 'max_uses': 'int', 'current_uses': 'int',
+        'min_age': 'int', 'max_age': 'int',
+    }
+
+    def test_unnest_arrays_follow_insert_columns(self, etl):
+        """Test column list, array casts and parameters share one order."""
+        offer = {
+            'shop_id': 7, 'discount_percent': 15, 'description': 'Sconto',
+            'offer_type': 'percentage', 'valid_from': date(2025, 1, 1),
+            'valid_until': date(2025, 1, 8), 'is_active': True, 'max_uses': 100,
+            'current_uses': 0, 'min_age': 18, 'max_age': 30,
+        }
+        cur = MagicMock()
+        cur.fetchall.return_value = [(7,)]
+        service = etl.AirflowOffersService()
+
+        assert service._insert_offers([offer], cur) == [7]
+
+        sql, params = cur.execute.call_args[0]
+        columns = sql.split("INSERT INTO offers (", 1)[1].split(")", 1)[0]
+        assert [c.strip() for c in columns.split(",")] == list(etl.OFFER_INSERT_COLUMNS)
+
+        unnest_args = sql.split("unnest(", 1)[1].split(")", 1)[0]
+        casts = [arg.strip().replace("%s::", "").rstrip("[]") for arg in unnest_args.split(",")]
+        assert casts == [self.EXPECTED_CASTS[c] for c in etl.OFFER_INSERT_COLUMNS]
+
+        assert params == [[offer[c]] for c in etl.OFFER_INSERT_COLUMNS]
+
+
+@pytest.fixture
+def state_path(etl, tmp_path):
+    """Redirect the Overpass state file to a temporary directory."""
+    path = tmp_path / "overpass_state.json"
+    with patch.object(etl, "OVERPASS_DATA_DIR", str(tmp_path)), \
+            patch.object(etl, "OVERPASS_STATE_PATH", str(path)):
+        yield path
+
+
+class TestOverpassPayload:
+    """Unit tests for the Overpass payload check run before caching."""
+
+    @pytest.mark.parametrize("payload, expected", [
+        ({"elements": [{"type": "node", "tags": {"remark": "tag, not an error"}}]}, True),
+        ({"elements": [{"type": "node"}], "remark": "runtime error: Query timed out"}, False),
+        ({"elements": []}, False),
+        ({}, False),
+    ])
+    @pytest.mark.parametrize("streaming", [True, False])
+    def test_payload_ok(self, etl, tmp_path, payload, expected, streaming):
+        """Test payloads with a top-level remark or no elements are rejected."""
+        if streaming:
+            pytest.importorskip("ijson")
+        path = tmp_path / "payload.json"
+        path.write_text(json.dumps(payload))
+
+        with patch.object(etl, "ijson", etl.ijson if streaming else None):
+            assert etl._overpass_payload_ok(str(path)) is expected
+
+
+class TestShopsState:
+    """Unit tests for the shop-count state used to skip unchanged runs."""
+
+    def test_unchanged_after_save(self, etl, state_path):
+        """Test the same count within OVERPASS_REFRESH_MAX_AGE is unchanged."""
+        etl._save_shops_state(100)
+
+        assert etl._shops_unchanged(100) is True
+        assert etl._shops_unchanged(101) is False
+
+    def test_stale_state_is_changed(self, etl, state_path):
+        """Test a state older than OVERPASS_REFRESH_MAX_AGE forces a reload."""
+        loaded_at = etl.time.time() - etl.OVERPASS_REFRESH_MAX_AGE - 1
+        state_path.write_text(json.dumps({"count": 100, "loaded_at": loaded_at}))
+
+        assert etl._shops_unchanged(100) is False
+
+    def test_missing_count_or_state(self, etl, state_path):
+        """Test an unknown count or a missing state never skips."""
+        assert etl._shops_unchanged(100) is False
+        etl._save_shops_state(None)
+        assert not state_path.exists()
+        assert etl._shops_unchanged(None) is False
+
+
+class TestEtlShops:
+    """Unit tests for the cache/precheck ordering in etl_shops."""
+
+    @pytest.fixture
+    def steps(self, etl, state_path):
+        """Patch the Overpass and database steps of etl_shops."""
+        with patch.object(etl, "_cached_overpass_payload", return_value=None) as cached, \
+                patch.object(etl, "_overpass_shop_count", return_value=5) as count, \
+                patch.object(etl, "extract_data", return_value=None) as extract, \
+                patch.object(etl, "load_data", side_effect=len) as load:
+            yield types.SimpleNamespace(cached=cached, count=count, extract=extract, load=load)
+
+    def test_cache_hit_skips_count(self, etl, steps, state_path, tmp_path):
+        """Test a cached payload is loaded without the count query or saving state."""
+        steps.cached.return_value = _write_overpass(tmp_path, [_node("Forno", 9.19, 45.46)])
+
+        assert etl.etl_shops() == 1
+        steps.count.assert_not_called()
+        steps.extract.assert_not_called()
+        assert not state_path.exists()
+
+    def test_unchanged_count_skips_download(self, etl, steps):
+        """Test an unchanged recent count returns 0 without downloading."""
+        etl._save_shops_state(5)
+
+        assert etl.etl_shops() == 0
+        steps.extract.assert_not_called()
+        steps.load.assert_not_called()
+
+    def test_fresh_download_saves_state(self, etl, steps, state_path, tmp_path):
+        """Test a downloaded payload records the count taken in the same run."""
+        steps.extract.return_value = _write_overpass(tmp_path, [_node("Forno", 9.19, 45.46)])
+
+        assert etl.etl_shops() == 1
+        assert json.loads(state_path.read_text())["count"] == 5
+
+    def test_failed_count_falls_through(self, etl, steps, state_path, tmp_path):
+        """Test an unavailable count still runs a full load."""
+        steps.count.return_value = None
+        steps.extract.return_value = _write_overpass(tmp_path, [_node("Forno", 9.19, 45.46)])
+
+        assert etl.etl_shops() == 1
+        steps.extract.assert_called_once()
+        assert not state_path.exists()
+
+    def test_empty_transform_saves_no_state(self, etl, steps, state_path):
+        """Test a run that transforms no shops does not record state."""
+        assert etl.etl_shops() == 0
+        steps.load.assert_called_once_with([])
+        assert not state_path.exists()